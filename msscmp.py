@@ -15,69 +15,185 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 from dataclasses import dataclass, field
-from io import SEEK_SET, BufferedReader
-import pprint, datetime
-import struct, os
-from typing import Callable, Any
+import pprint, time, atexit
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import chain, repeat
+from concurrent.futures import Future, ThreadPoolExecutor
+import struct, os, sys, mmap
+from typing import BinaryIO, Callable, ClassVar, Iterable, Iterator, TextIO, Any
+
+#! files written by Logger.logFn stay open for the process lifetime and are closed at exit
+_logFiles: dict[str, TextIO] = {}
+
+def _logFile(filename: str) -> TextIO:
+    logFile = _logFiles.get(filename)
+    if logFile is None:
+        logFile = _logFiles[filename] = open(filename, "a", buffering=65536)
+    return logFile
+
+@atexit.register
+def _closeLogFiles() -> None:
+    for logFile in _logFiles.values(): logFile.close()
+
+def _utcTimestamp() -> str:
+    # HH:MM:SS.ffffff, what datetime.time(utcnow()) printed
+    now = time.time()
+    return f"{time.strftime('%H:%M:%S', time.gmtime(now))}.{int(now % 1 * 1_000_000):06d}"
 
 class Logger:
-    def logFn(logTarget: str | None = ...) -> Callable[[], Any]:
+    #! one buffered handle per log target, kept open for the whole parse
+    #! pretty: pprint entries, much slower than the default single line repr()
+    def __init__(self, targetFile: str, pretty: bool = False) -> None:
+        self._file = open(f"{targetFile}.txt", "a", buffering=1 << 20)
+        self._start = time.monotonic_ns()
+        self._format: Callable[[object], str] = pprint.pformat if pretty else repr
+
+    def __enter__(self) -> "Logger":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def log(self, __obj: object) -> None:
+        print(f"[+{(time.monotonic_ns() - self._start) // 1_000}us]: {self._format(__obj)}", file=self._file)
+
+    @staticmethod
+    def logFn(logTarget: str | None = ..., pretty: bool = False) -> Callable[[], Any]:
+        formatter: Callable[[object], str] = pprint.pformat if pretty else repr
         def decorater(func: Callable[[Ellipsis], Any]):
             logFilename = f"{logTarget}.txt" if isinstance(logTarget, str) else f"{func.__name__}.txt"
             def caller(*args, **kwargs):
                 res = func(*args, **kwargs)
-                with open(logFilename, "a") as logFile:
-                    print(f"[{datetime.datetime.time(datetime.datetime.utcnow())}] {repr(func.__name__)}: {pprint.pformat(res)}", file=logFile)
+                print(f"[{_utcTimestamp()}] {repr(func.__name__)}: {formatter(res)}", file=_logFile(logFilename))
                 return res
             return caller
         return decorater
 
-    def logIf(condition: bool, __obj: object, targetFile: str | None = ...) -> None:
-        if (condition): Logger.log(__obj, targetFile)
+#! compiled once per (endianness, count), covers single ints up to whole offset tables
+@lru_cache(maxsize=None)
+def _intStruct(endianness: str, count: int) -> struct.Struct:
+    return struct.Struct(f"{endianness}{count}i")
 
-    def log(__obj: object, targetFile: str | None = ...) -> None:
-        logFilename = f"{targetFile}.txt" if isinstance(targetFile, str) else f"{__obj}.txt"
-        with open(logFilename, "a") as logFile:
-            print(f"[{datetime.datetime.time(datetime.datetime.utcnow())}]: {pprint.pformat(__obj)}", file=logFile)
+@lru_cache(maxsize=None)
+def _floatStruct(endianness: str, count: int) -> struct.Struct:
+    return struct.Struct(f"{endianness}{count}f")
 
+#! whole source record (0x00 - 0x3C), 0x34 being the only float
+_SOURCE_STRUCTS: dict[str, struct.Struct] = {endianness: struct.Struct(f"{endianness}13ifi") for endianness in ('<', '>')}
+#! fixed location of the bank name inside the header
+_BANK_NAME_OFFSET = 0x38
+
+#! use BigEndianDataReader / LittleEndianDataReader, they bake the byte order into their structs
 @dataclass(slots=True)
 class BufferedDataReader:
-    _stream: BufferedReader
-    _endianness: str = field(default='>') # big endian
+    endianness: ClassVar[str]
+    _int: ClassVar[struct.Struct]
+    _float: ClassVar[struct.Struct]
+
+    _buffer: memoryview
+    _pos: int = field(default=0)
+    #! the file the mapping was made from, sendfile() source for this bank's payloads
+    _stream: BinaryIO | None = field(default=None, repr=False)
+    #! decoded strings by offset, tables refer to the same names more than once
+    _strings: dict[int, str] = field(init=False, default_factory=dict, repr=False)
 
     @property
-    def stream(self) -> BufferedReader:
+    def buffer(self) -> memoryview:
+        return self._buffer
+
+    @property
+    def stream(self) -> BinaryIO | None:
         return self._stream
 
+    def tell(self) -> int:
+        return self._pos
+
     def readInts(self, count: int) -> tuple[int, ...]:
-        return struct.unpack(f"{self._endianness}{count}i", self._stream.read(count*4))
+        result = _intStruct(self.endianness, count).unpack_from(self._buffer, self._pos)
+        self._pos += count*4
+        return result
 
     def readInt(self) -> int:
-        return self.readInts(1)[0]
+        result = self._int.unpack_from(self._buffer, self._pos)[0]
+        self._pos += 4
+        return result
 
     def readFloats(self, count: int) -> tuple[float, ...]:
-        return struct.unpack(f"{self._endianness}{count}f", self._stream.read(count*4))
+        result = _floatStruct(self.endianness, count).unpack_from(self._buffer, self._pos)
+        self._pos += count*4
+        return result
 
     def readFloat(self) -> float:
-        return self.readFloats(1)[0]
+        result = self._float.unpack_from(self._buffer, self._pos)[0]
+        self._pos += 4
+        return result
+
+    # *At variants read from an absolute offset and leave the cursor untouched
+    def readIntsAt(self, offset: int, count: int) -> tuple[int, ...]:
+        return _intStruct(self.endianness, count).unpack_from(self._buffer, offset)
+
+    def readIntPairsAt(self, offset: int, count: int) -> Iterator[tuple[int, int]]:
+        values = self.readIntsAt(offset, count*2)
+        return zip(values[0::2], values[1::2])
 
     def readString(self) -> str:
-        return self.readStringAt(self._stream.tell())
+        return self.readStringAt(self._pos)
 
     def readStringAt(self, offset: int) -> str:
-        return readAt(self._stream, offset, self.readUntil, b'\x00').decode("ASCII")
+        result = self._strings.get(offset)
+        if result is None:
+            result = self._strings[offset] = self.readCStringAt(offset).decode("ASCII")
+        return result
+
+    def cacheStringsAt(self, offsets: Iterable[int]) -> None:
+        # decoding in file order walks the string table front to back instead of jumping around the mapping
+        for offset in sorted(offsets): self.readStringAt(offset)
+
+    def readDirnameAt(self, offset: int) -> str:
+        # only the directory part of the path gets decoded
+        path = self.readCStringAt(offset)
+        return path[:max(path.rfind(b'/'), 0)].decode("ASCII")
+
+    def readCStringAt(self, offset: int) -> bytes:
+        #! _buffer.obj is the underlying mmap, its find() is a single memchr over the mapping
+        #! and slicing it yields bytes directly, without an intermediate memoryview
+        mapping = self._buffer.obj
+        end = mapping.find(b'\x00', offset)
+        if end < 0:
+            raise Exception(f"Unterminated string at {offset}(0x{offset:x})")
+        return mapping[offset:end]
 
-    def readUntil(self, stopper: bytes) -> bytes:
-        result = bytearray()
-        while self._stream.peek(1)[:1] != stopper: result.append(self._stream.read(1)[0])
-        return bytes(result)
+@dataclass(slots=True)
+class BigEndianDataReader(BufferedDataReader):
+    endianness: ClassVar[str] = '>'
+    _int: ClassVar[struct.Struct] = _intStruct('>', 1)
+    _float: ClassVar[struct.Struct] = _floatStruct('>', 1)
 
-def readAt(stream: BufferedReader, offset: int, func: Callable[[Ellipsis], Any], *arg, **kwargs) -> Any:
-    origin = stream.tell()
-    stream.seek(offset, SEEK_SET)
-    result = func(*arg, **kwargs)
-    stream.seek(origin, SEEK_SET)
-    return result
+@dataclass(slots=True)
+class LittleEndianDataReader(BufferedDataReader):
+    endianness: ClassVar[str] = '<'
+    _int: ClassVar[struct.Struct] = _intStruct('<', 1)
+    _float: ClassVar[struct.Struct] = _floatStruct('<', 1)
+
+#! sendfile() into a regular file is only supported by linux
+_HAS_SENDFILE = sys.platform.startswith("linux")
+_HAS_FALLOCATE = hasattr(os, "posix_fallocate")
+#! dumping is I/O bound, so more writers than cores keeps the disk queue full
+_DUMP_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def sendAt(source: BinaryIO, target: BinaryIO, offset: int, size: int) -> int:
+    # kernel side copy, the data never passes through a python buffer
+    # stops short at the end of the source like read() would, returns the bytes copied
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(target.fileno(), source.fileno(), offset + copied, size - copied)
+        if sent == 0: break
+        copied += sent
+    return copied
 
 @dataclass(frozen=True, slots=True)
 class BankHeader:
@@ -86,17 +202,56 @@ class BankHeader:
     mem_usage: int
     version: int
 
-@dataclass(frozen=True, slots=True)
+@dataclass(slots=True)
 class BankSource:
     path_offset: int
-    path: str
+    info_offset: int
+    directory: str
     file_name: str
     file_size: int
     sample_rate: int
     data_offset: int
     play_action: int
-    unknown_data: dict = field(default_factory=dict)
-    data: bytes = field(default_factory=bytes, repr=False)
+    _reader: BufferedDataReader = field(repr=False, compare=False)
+
+    #! decoded on first access only, the reader's string cache keeps the result
+    @property
+    def path(self) -> str:
+        return self._reader.readStringAt(self.path_offset)
+
+    #! zero-copy view into the mapped bank, nothing is read until it is used
+    @property
+    def data(self) -> memoryview:
+        return self._reader.buffer[self.data_offset:self.data_offset + self.file_size]
+
+@dataclass(slots=True)
+class BankSourceUnknownData:
+    source_offset: int
+    unknown_0x08: int
+    unknown_0x10: int
+    channels: int
+    unknown_0x20: int
+    duration_milliseconds: int
+    unknown_0x28: int
+    unknown_0x2C: int
+    unknown_0x30: int
+    unknown_0x34: float
+    unknown_0x38: int
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "source_offset": self.source_offset,
+            "0x08": hex(self.unknown_0x08),
+            "0x10": self.unknown_0x10,
+            "Channels": self.channels,
+            "0x20": self.unknown_0x20,
+            "Duration": f"{self.duration_milliseconds} ms ({self.duration_milliseconds/1_000} sec)",
+            "0x28": self.unknown_0x28,
+            "0x2C": self.unknown_0x2C,
+            "0x30": self.unknown_0x30,
+            "0x34": self.unknown_0x34,
+            "0x38": self.unknown_0x38,
+        }
 
 @dataclass(slots=True)
 class BankEvent:
@@ -109,64 +264,111 @@ class BankEvent:
 class BankInfo:
     header: BankHeader = field(init=False)
     events: dict[str, BankEvent] = field(default_factory=dict)
+    #! not yet understood source fields, keyed by BankSource.info_offset
+    unknown_data: dict[int, BankSourceUnknownData] = field(default_factory=dict)
 
 @dataclass(slots=True)
 class MsscmpParser:
     bankinfo: BankInfo = field(init=False, default_factory=BankInfo)
     verbose: bool = field(default=False)
+    pretty: bool = field(default=False)
+    _directories: set[str] = field(init=False, default_factory=set, repr=False)
 
-    def process(self, stream: BufferedReader):
+    def process(self, stream: BinaryIO, dumpPath: str | None = None):
         #! 0x42414e4b == b'BANK' | Big Endian
         #! 0x4b4e4142 == b'KNAB' | Little Endian
         signature = stream.read(4)
         if signature not in  (b'BANK', b'KNAB'):
             raise Exception("File is not a Soundbank.")
-        reader = BufferedDataReader(stream, '<' if signature == b'KNAB' else '>')
+        #! the mapping outlives the stream, sources keep zero-copy views into it
+        buffer = memoryview(mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ))
+        reader = (LittleEndianDataReader if signature == b'KNAB' else BigEndianDataReader)(buffer, len(signature), stream)
 
         self.bankinfo.header = self.readBankHeader(reader)
 
-        print(f"{stream.tell()=}")
+        print(f"{reader.tell()=}")
 
         __start,       event_table_start, *__unknown_data_table_start, source_table_start  = reader.readInts(5)
         __start_count, event_count,       *__unknown_data_count,       source_count        = reader.readInts(5)
 
-        if (stream.tell() != event_table_start):
-            stream.seek(event_table_start, SEEK_SET)
-
-        for _ in range(event_count):
-            offset_event_name, offset_event_details = reader.readInts(2)
-            event_name = reader.readStringAt(offset_event_name)
-            raw_property_string = reader.readStringAt(offset_event_details)
-            event = BankEvent(event_name, raw_property_string)
-
-            Logger.logIf(self.verbose, event, "MSSEvents")
-
-            event.properties = self.decodeEventProperties(raw_property_string)
-
-            self.bankinfo.events[os.path.dirname(event_name)] = event
-
-        if (stream.tell() != source_table_start):
-            stream.seek(source_table_start, SEEK_SET)
-
-        for _ in range(source_count):
-            path_offset, info_offset = reader.readInts(2)
-            source: BankSource = readAt(stream, info_offset, self.readBankSource, reader, path_offset)
-            event_name: str = os.path.dirname(source.path)
-            if self.bankinfo.events.get(event_name, None) is not None:
-                self.bankinfo.events[event_name].sources.append(source)
-
-            Logger.logIf(self.verbose, source, "BankSources")
-
+        with Logger("MSSEvents", self.pretty) if self.verbose else nullcontext() as eventLog:
+            event_offsets = list(reader.readIntPairsAt(event_table_start, event_count))
+            reader.cacheStringsAt(chain.from_iterable(event_offsets))
+            for offset_event_name, offset_event_details in event_offsets:
+                event_name = reader.readStringAt(offset_event_name)
+                raw_property_string = reader.readStringAt(offset_event_details)
+                event = BankEvent(event_name, raw_property_string)
+
+                if eventLog is not None: eventLog.log(event)
+
+                event.properties = self.decodeEventProperties(raw_property_string)
+
+                # same as os.path.dirname for the relative '/' separated bank paths, minus its bookkeeping
+                self.bankinfo.events[event_name[:max(event_name.rfind('/'), 0)]] = event
+
+        dumps: list[Future] = []
+        if dumpPath is not None:
+            print("Dumping...")
+        with (
+            Logger("BankSources", self.pretty) if self.verbose else nullcontext() as sourceLog,
+            ThreadPoolExecutor(_DUMP_WORKERS) if dumpPath is not None else nullcontext() as dumpPool,
+        ):
+            for path_offset, info_offset in reader.readIntPairsAt(source_table_start, source_count):
+                source: BankSource = self.readBankSource(reader, info_offset, path_offset)
+                event = self.bankinfo.events.get(source.directory, None)
+                if event is not None:
+                    event.sources.append(source)
+                    # writes release the GIL, so they overlap with parsing the remaining sources
+                    if dumpPool is not None:
+                        self.createSourceDirectory(dumpPath, source.directory)
+                        dumps.append(dumpPool.submit(self.writeSource, source, dumpPath))
+
+                if sourceLog is not None: sourceLog.log((source.path, source, self.bankinfo.unknown_data[info_offset].describe()))
+
+        for dump in dumps: dump.result()
+
+    # after-the-fact dump of an already processed bank, process(stream, dumpPath) dumps while parsing
     def dumpAllSources(self, path: str) -> None:
-        for event in self.bankinfo.events.values():
-            for source in event.sources:
-                self.dumpSource(source, path)
+        sources = [source for event in self.bankinfo.events.values() for source in event.sources]
+        # directories first, so the writers never race on makedirs
+        for directory in {source.directory for source in sources}:
+            self.createSourceDirectory(path, directory)
+        with ThreadPoolExecutor(_DUMP_WORKERS) as dumpPool:
+            list(dumpPool.map(self.writeSource, sources, repeat(path)))
 
     def dumpSource(self, bankSource: BankSource, path: str):
-        full_path = f"{path}/{os.path.dirname(bankSource.path)}"
-        if not os.path.exists(full_path): os.makedirs(full_path)
+        self.createSourceDirectory(path, bankSource.directory)
+        self.writeSource(bankSource, path)
+
+    def createSourceDirectory(self, path: str, directory: str) -> None:
+        full_path = f"{path}/{directory}"
+        # sources of one event share a directory, only the first one hits the filesystem
+        if full_path not in self._directories:
+            os.makedirs(full_path, exist_ok=True)
+            self._directories.add(full_path)
+
+    def writeSource(self, bankSource: BankSource, path: str) -> None:
         with open(f"{path}/{bankSource.path}.binka", "wb") as f:
-            f.write(bankSource.data)
+            # reserve the whole file in one go rather than growing it block by block
+            # only a hint, some filesystems and libcs refuse it
+            if _HAS_FALLOCATE and bankSource.file_size > 0:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, bankSource.file_size)
+                except OSError:
+                    pass
+            written = None
+            # a parser can process several banks, always copy from the one this source belongs to
+            stream = bankSource._reader.stream
+            if _HAS_SENDFILE and stream is not None and not stream.closed:
+                try:
+                    written = sendAt(stream, f, bankSource.data_offset, bankSource.file_size)
+                except OSError:
+                    # some filesystems refuse sendfile(), start over with a plain write
+                    f.seek(0)
+            if written is None:
+                written = f.write(bankSource.data)
+            # drop the preallocated tail when the payload came up short
+            f.truncate(written)
 
     def decodeEventProperties(self, raw_property_event_string: str) -> list[str]:
         properties: list[str] = raw_property_event_string.split(';')
@@ -177,42 +379,30 @@ class MsscmpParser:
         # @mem_usage: Number of bytes required to build source info(name, file_name, file_location, file_size, ...)
         version, mem_usage, _ = reader.readInts(3)
         filename = reader.readString()
-        name = reader.readStringAt(0x38)
+        name = reader.readStringAt(_BANK_NAME_OFFSET)
         return BankHeader(name, filename, mem_usage, version)
 
-    def readBankSource(self, reader: BufferedDataReader, source_path_offset: int) -> BankSource:
-        current_offset = reader.stream.tell()
-        unknown_data = dict()
-        unknown_data["source_offset"] = current_offset
-
-        recived_source_name_offset = reader.readInt()
+    def readBankSource(self, reader: BufferedDataReader, current_offset: int, source_path_offset: int) -> BankSource:
+        # play_action: type(1 = play, 2 = loop) note: random guess based on seen source objcets
+        # file_size: Minimal file buffer size allocated/alignment: 4Kb
+        (recived_source_name_offset, file_name_offset, unknown_0x08, play_action, unknown_0x10, sample_rate, file_size, channels,
+         unknown_0x20, duration_milliseconds, unknown_0x28, unknown_0x2C, unknown_0x30, unknown_0x34, unknown_0x38) = _SOURCE_STRUCTS[reader.endianness].unpack_from(reader.buffer, current_offset)
         if (source_path_offset != recived_source_name_offset):
             raise Exception(f"Unexpected offset difference: Expected {source_path_offset}(0x{source_path_offset:x}) got {recived_source_name_offset}(0x{recived_source_name_offset:x})")
 
-        path_name = reader.readStringAt(source_path_offset)
         # The filename is build up of the file size and the file offset written as decimal number separated by an asterisks('*') and end inf the '.binka' file extention.
-        file_name = reader.readStringAt(reader.readInt() + current_offset)
-        unknown_data["0x08"] = hex(reader.readInt())
-        play_action = reader.readInt() # type(1 = play, 2 = loop) note: random guess based on seen source objcets
-        unknown_data["0x10"] = reader.readInt()
-        sample_rate = reader.readInt()
-        # Minimal file buffer size allocated/alignment: 4Kb
-        file_size = reader.readInt()
-        unknown_data["Channels"] = reader.readInt()
-        unknown_data["0x20"] = reader.readInt()
-        duration_milliseconds = reader.readInt()
-        unknown_data["Duration"] = f"{duration_milliseconds} ms ({duration_milliseconds/1_000} sec)"
-        unknown_data["0x28"] = reader.readInt()
-        unknown_data["0x2C"] = reader.readInt()
-        unknown_data["0x30"] = reader.readInt()
-        unknown_data["0x34"] = reader.readFloat()
-        unknown_data["0x38"] = reader.readInt()
-        
-        if unknown_data["0x2C"] or unknown_data["0x30"] or unknown_data["0x38"] > 0:
-            print(unknown_data)
-
-        data_offset = int(file_name.split('*')[-1].rsplit('.')[0]) # yes :^)
-
-        data = readAt(reader.stream, data_offset, reader.stream.read, file_size)
-
-        return BankSource(source_path_offset, path_name, file_name, file_size, sample_rate, data_offset, play_action, unknown_data, data)
\ No newline at end of file
+        file_name = reader.readStringAt(file_name_offset + current_offset)
+        unknown_data = BankSourceUnknownData(current_offset, unknown_0x08, unknown_0x10, channels, unknown_0x20, duration_milliseconds,
+                                             unknown_0x28, unknown_0x2C, unknown_0x30, unknown_0x34, unknown_0x38)
+
+        if unknown_0x2C or unknown_0x30 or unknown_0x38 > 0:
+            print(unknown_data.describe())
+
+        # "<...>*<size>*<offset>.binka" -> <offset>
+        offset_start = file_name.rfind('*') + 1
+        offset_end = file_name.find('.', offset_start)
+        data_offset = int(file_name[offset_start:offset_end if offset_end >= 0 else None]) # yes :^)
+
+        self.bankinfo.unknown_data[current_offset] = unknown_data
+
+        return BankSource(source_path_offset, current_offset, reader.readDirnameAt(source_path_offset), file_name, file_size, sample_rate, data_offset, play_action, reader)
\ No newline at end of file
@@ -5,6 +5,7 @@ def main():
     argparser = ArgumentParser()
     argparser.add_argument("filepath", action="store", help="Sound Bank filepath.")
     argparser.add_argument("-v", "--verbose", action="store_true", default=False, help="Output debug info (be verbose).")
+    argparser.add_argument("-p", "--pretty", action="store_true", default=False, help="Pretty print the verbose debug info (slower).")
     argparser.add_argument("-d", "--dump", action="store", default=None, metavar="path", help="Dumps bank sources into a directory.")
     args = argparser.parse_args()
 
@@ -13,12 +14,10 @@ def main():
     if not args.filepath.endswith(".msscmp"):
         raise Exception("Not a Soundbank(.msscmp) file")
 
-    with open(args.filepath, "rb") as file: 
-        msscmpfile = msscmp.MsscmpParser(args.verbose)
-        msscmpfile.process(file)
-        if args.dump is not None:
-            print("Dumping...")
-            msscmpfile.dumpAllSources(args.dump)
+    # unbuffered: the bank is mmap'd, the stream only serves the signature and sendfile()
+    with open(args.filepath, "rb", buffering=0) as file: 
+        msscmpfile = msscmp.MsscmpParser(args.verbose, args.pretty)
+        msscmpfile.process(file, args.dump)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file